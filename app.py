@@ -1,13 +1,39 @@
-import os, tempfile, re
+import os, tempfile, re, shutil, mmap, types, hashlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 import streamlit as st
-import pandas as pd
-from pipeline_inmemory import run_pipeline_in_memory
 
 st.set_page_config(page_title="Mortgage Statement Consolidation", page_icon="📊", layout="centered")
 
+@lru_cache(maxsize=1)
+def _config():
+    # read the environment once per process instead of on every rerun
+    return types.SimpleNamespace(
+        passcode=os.environ.get("APP_PASSCODE", ""),
+        ocr=os.environ.get("OCR_PROVIDER", "gcv").lower(),
+        sa_json=os.environ.get("GOOGLE_APPLICATION_CREDENTIALS_JSON", ""),
+    )
+
+@lru_cache(maxsize=1)
+def _ensure_gcv_credentials():
+    # Write the service-account JSON to one well-known temp path instead of a
+    # fresh NamedTemporaryFile per click (which leaked files under /tmp).
+    if _config().ocr != "gcv" or not _config().sa_json:
+        return
+    existing = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS", "")
+    if existing and os.path.exists(existing):
+        return
+    sa_path = Path(tempfile.gettempdir()) / "gcv-sa.json"
+    fd = os.open(sa_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as fh:
+        fh.write(_config().sa_json)
+    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = str(sa_path)
+
+_ensure_gcv_credentials()
+
 # --- passcode gate ---
-PASS = os.environ.get("APP_PASSCODE", "")
+PASS = _config().passcode
 if PASS:
     with st.sidebar:
         st.header("Access")
@@ -16,6 +42,13 @@ if PASS:
         st.info("Enter passcode to use the app.")
         st.stop()
 
+# Heavy imports live below the passcode gate: reruns while the user is still
+# typing the passcode stop above and never pay for pandas/openpyxl/the
+# pipeline (and its OCR clients). Python's module cache makes later reruns free.
+import pandas as pd
+from openpyxl import load_workbook
+from pipeline_inmemory import run_pipeline_in_memory
+
 BASE = Path(__file__).parent
 DEFAULTS_DIR = BASE / "defaults"
 
@@ -28,7 +61,7 @@ DEFAULT_TEMPLATE_PATH = DEFAULTS_DIR / "Mortgage_Template.xlsx"
 
 st.title("📊 Mortgage Statement Consolidation")
 st.caption("Uploads are processed in memory and discarded after the Excel is generated.")
-st.write(f"**OCR Provider:** `{os.environ.get('OCR_PROVIDER','gcv').lower()}`")
+st.write(f"**OCR Provider:** `{_config().ocr}`")
 
 # Required each run
 pdf_files = st.file_uploader("Upload mortgage PDFs (text or scanned)", type=["pdf"], accept_multiple_files=True)
@@ -45,27 +78,119 @@ EXPECTED_HEADERS = [
  "Escrow-Immediate Replacement Reserve","Escrow-Replacement Reserve","Escrow-Renovation Reserve","Other Escrows"
 ]
 
+@lru_cache(maxsize=1024)
 def _norm(s):
+    # pure, tiny input domain (header strings) — memoize repeat calls
     return "".join(str(s).strip().lower().replace("-", " ").replace("_", " ").split())
 
 def _normalize_cols(cols):
-    return {c: _norm(c) for c in cols}
-
-def _pick(colmap, *cands):
+    s = pd.Index(cols).astype("string")
+    norm = (s.str.strip().str.lower()
+             .str.replace("-", " ", regex=False)
+             .str.replace("_", " ", regex=False)
+             .str.replace(r"\s+", "", regex=True))
+    return dict(zip(cols, norm.tolist()))
+
+def _invert_colmap(colmap):
+    # normalized -> original; on collisions the first column wins,
+    # matching the old linear scan over colmap.
+    inv = {}
     for orig, normed in colmap.items():
-        if normed in cands:
-            return orig
+        inv.setdefault(normed, orig)
+    return inv
+
+def _pick(inv, *cands):
+    for c in cands:
+        hit = inv.get(c)
+        if hit:
+            return hit
     return None
 
-def _load_default_vendor_df():
+# Everything we consume is text; declaring dtypes up front skips pandas'
+# per-column type-inference pass on each load.
+DG_DTYPES = {"Property": "string", "Description": "string"}
+VENDOR_DTYPES = {"Vendor": "string", "Pattern": "string", "MappedHeader": "string", "DetectPattern": "string"}
+
+# pyarrow's CSV reader is several times faster on string-heavy files and
+# yields arrow-backed string columns directly; optional, default engine otherwise.
+try:
+    import pyarrow  # noqa: F401
+    _CSV_KW = {"engine": "pyarrow", "dtype_backend": "pyarrow"}
+    _STR_DTYPE = "string[pyarrow]"
+except ImportError:
+    _CSV_KW = {"dtype": "string"}
+    _STR_DTYPE = "string"
+
+# acceptable DataGrid header spellings, normalized (lowered, spaces/underscores dropped)
+DG_CODE_ALIASES = {"property", "propertycode", "prop", "propid", "propertyid", "property_code"}
+DG_NAME_ALIASES = {"description", "propertyname", "name", "propname", "property_description", "propertydesc"}
+
+def _norm_header(c):
+    return str(c).strip().lower().replace(" ", "").replace("_", "")
+
+def _read_xlsx_fast(buf, dtype=None, required=None, prune=False):
+    """
+    Stream an xlsx into a DataFrame via openpyxl read_only mode.
+    Avoids building the full workbook DOM that pd.read_excel(engine="openpyxl")
+    creates — much faster and far lower peak memory on big uploads.
+    `required` is an optional tuple of alias sets checked against the header
+    row, so a bad workbook is rejected before any data row is materialized.
+    With `prune=True`, only columns matching one of the alias sets are kept.
+    """
+    wb = load_workbook(buf, read_only=True, data_only=True, keep_links=False)
+    try:
+        ws = wb.worksheets[0]
+        rows = ws.iter_rows(values_only=True)
+        try:
+            header_row = next(rows)
+        except StopIteration:
+            raise ValueError("Workbook has no header row (the first sheet is empty).") from None
+        if required:
+            normed = {_norm_header(h) for h in header_row if h is not None}
+            for aliases in required:
+                if not (aliases & normed):
+                    raise ValueError(
+                        f"Workbook is missing a required column (one of: {sorted(aliases)}). "
+                        f"Found: {[h for h in header_row if h is not None]}"
+                    )
+        if required and prune:
+            wanted = set().union(*required)
+            keep_idx = [i for i, h in enumerate(header_row) if _norm_header(h) in wanted]
+            headers = [str(header_row[i]) for i in keep_idx]
+            df = pd.DataFrame(
+                ([r[i] if i < len(r) else None for i in keep_idx] for r in rows),
+                columns=headers,
+            )
+        else:
+            headers = [str(h) if h is not None else "" for h in header_row]
+            df = pd.DataFrame(rows, columns=headers)
+        if dtype:
+            df = df.astype({c: t for c, t in dtype.items() if c in df.columns})
+        return df
+    finally:
+        wb.close()
+
+@st.cache_data(show_spinner=False)
+def _cached_default_vendor(mtimes: tuple):
+    # mtimes is only the cache key; the files are re-read when it changes.
     for p in VENDOR_CANDIDATES:
         if p.exists():
-            return pd.read_csv(p), f"(default: {p.name})"
+            return pd.read_csv(p, **_CSV_KW), f"(default: {p.name})"
     raise FileNotFoundError(
         "Default vendor log not found in /defaults (expected one of: "
         "VendorInformationLog.csv, 'Vendor Information Log v2.csv')."
     )
 
+@st.cache_data(show_spinner=False)
+def _cached_default_template_bytes(mtime: int):
+    return DEFAULT_TEMPLATE_PATH.read_bytes()
+
+def _default_file_key():
+    return tuple((p.as_posix(), p.stat().st_mtime_ns if p.exists() else 0) for p in VENDOR_CANDIDATES)
+
+def _load_default_vendor_df():
+    return _cached_default_vendor(_default_file_key())
+
 # map friendly/wide column names to exact template headers
 WIDE_TO_TEMPLATE = {
     "principalbalance": "Mortgage 1st",
@@ -100,9 +225,10 @@ def _explode_wide_vendor(df_raw: pd.DataFrame) -> pd.DataFrame:
     if df_raw is None or df_raw.empty:
         raise ValueError("Vendor log is empty.")
     colmap = _normalize_cols(df_raw.columns)
+    inv = _invert_colmap(colmap)
 
-    vendor_col = _pick(colmap, "vendor", "servicer", "lender")
-    detect_col = _pick(colmap, "detectpattern", "detect", "vendordetect", "identifier", "regex")  # optional
+    vendor_col = _pick(inv, "vendor", "servicer", "lender")
+    detect_col = _pick(inv, "detectpattern", "detect", "vendordetect", "identifier", "regex")  # optional
 
     if not vendor_col:
         raise ValueError("Vendor log is missing a 'Vendor' column (e.g., Vendor/Servicer/Lender).")
@@ -121,24 +247,45 @@ def _explode_wide_vendor(df_raw: pd.DataFrame) -> pd.DataFrame:
             f"Expected something like: {', '.join(sorted(set(WIDE_TO_TEMPLATE.values())))}"
         )
 
-    rows = []
-    for _, r in df_raw.iterrows():
-        vendor = str(r[vendor_col]).strip()
-        detect = str(r[detect_col]).strip() if detect_col else ""
-        for orig, mapped in header_cols:
-            cell = r.get(orig, "")
-            if pd.isna(cell):
-                continue
-            text = str(cell).strip()
-            if not text:
-                continue
-            parts = [p.strip() for p in SPLIT_RX.split(text) if p.strip()]
-            for pat in parts:
-                rows.append({"Vendor": vendor, "Pattern": pat, "MappedHeader": mapped, "DetectPattern": detect})
-
-    if not rows:
+    # melt + vectorized split/explode: the whole unpivot runs in C instead of
+    # V x H Python iterations over iterrows
+    src_to_header = dict(header_cols)
+    id_vars = [vendor_col] + ([detect_col] if detect_col else [])
+    long = df_raw.melt(id_vars=id_vars, value_vars=list(src_to_header),
+                       var_name="SrcCol", value_name="Pattern")
+    long = long.dropna(subset=["Pattern"])
+    long["Pattern"] = long["Pattern"].astype(str).str.strip()
+    long = long[long["Pattern"] != ""]
+    long["Pattern"] = long["Pattern"].str.split(SPLIT_RX)
+    long = long.explode("Pattern")
+    long["Pattern"] = long["Pattern"].str.strip()
+    long = long[long["Pattern"] != ""]
+
+    if long.empty:
         raise ValueError("Vendor log has no non-empty pattern cells to use.")
-    return pd.DataFrame(rows, columns=["Vendor","Pattern","MappedHeader","DetectPattern"])
+    return pd.DataFrame({
+        "Vendor": long[vendor_col].fillna("").astype(str).str.strip(),
+        "Pattern": long["Pattern"],
+        "MappedHeader": long["SrcCol"].map(src_to_header),
+        "DetectPattern": long[detect_col].fillna("").astype(str).str.strip() if detect_col else "",
+    }).reset_index(drop=True)
+
+def _compile_detect_db(df: pd.DataFrame) -> dict:
+    """
+    Compile each vendor's DetectPattern regexes into a single alternation so
+    the pipeline can score a PDF with one scan per vendor instead of one
+    re.search per pattern. Invalid regexes are skipped rather than fatal.
+    """
+    db = {}
+    for vendor, grp in df.groupby("Vendor"):
+        pats = [p for p in dict.fromkeys(grp["DetectPattern"]) if p]
+        if not pats:
+            continue
+        try:
+            db[vendor] = re.compile("|".join(f"(?:{p})" for p in pats), re.I | re.M)
+        except re.error:
+            continue
+    return db
 
 def _normalize_vendor_df(df_raw: pd.DataFrame) -> pd.DataFrame:
     """
@@ -147,28 +294,75 @@ def _normalize_vendor_df(df_raw: pd.DataFrame) -> pd.DataFrame:
     - Wide format: Vendor + one column per header with pattern lists
     """
     colmap = _normalize_cols(df_raw.columns)
+    inv = _invert_colmap(colmap)
 
     # detect "long" format quickly
-    maybe_vendor = _pick(colmap, "vendor", "servicer", "lender")
-    has_pattern = _pick(colmap, "pattern", "field", "label", "line", "item", "keyword", "match", "matchtext", "description")
-    has_mapped  = _pick(colmap, "mappedheader", "header", "mapto", "mapped", "column", "destination", "templateheader")
+    maybe_vendor = _pick(inv, "vendor", "servicer", "lender")
+    has_pattern = _pick(inv, "pattern", "field", "label", "line", "item", "keyword", "match", "matchtext", "description")
+    has_mapped  = _pick(inv, "mappedheader", "header", "mapto", "mapped", "column", "destination", "templateheader")
 
     if maybe_vendor and has_pattern and has_mapped:
-        detect_col = _pick(colmap, "detectpattern", "detect", "vendordetect", "identifier", "regex")
+        detect_col = _pick(inv, "detectpattern", "detect", "vendordetect", "identifier", "regex")
+        # rename already detaches from df_raw; the old .copy() doubled memory for nothing
         df = df_raw.rename(columns={
             maybe_vendor: "Vendor",
             has_pattern:  "Pattern",
             has_mapped:   "MappedHeader",
             **({detect_col: "DetectPattern"} if detect_col else {})
-        }).copy()
+        })
         if "DetectPattern" not in df.columns:
             df["DetectPattern"] = ""
-        for c in ["Vendor","Pattern","MappedHeader","DetectPattern"]:
-            df[c] = df[c].astype(str).fillna("").str.strip()
-        return df
-
-    # otherwise treat as wide
-    return _explode_wide_vendor(df_raw)
+        # one block-wise cast + strip instead of four independent column passes
+        cols = ["Vendor","Pattern","MappedHeader","DetectPattern"]
+        df[cols] = df[cols].astype(_STR_DTYPE).fillna("").apply(lambda s: s.str.strip())
+    else:
+        # otherwise treat as wide
+        df = _explode_wide_vendor(df_raw)
+
+    # low-cardinality key columns: categorical codes make the pipeline's
+    # groupby/equality work on ints instead of Python strings
+    for c in ("Vendor", "MappedHeader"):
+        df[c] = df[c].astype("category")
+
+    df.attrs["detect_db"] = _compile_detect_db(df)
+    return df
+
+@st.cache_data(show_spinner=False,
+               hash_funcs={pd.DataFrame: lambda df: pd.util.hash_pandas_object(df, index=True).sum()})
+def _normalize_vendor_df_cached(df_raw: pd.DataFrame) -> pd.DataFrame:
+    # reruns with the same raw vendor frame skip the explode/normalize and
+    # the detect-regex compilation entirely
+    return _normalize_vendor_df(df_raw)
+
+def _spill_to_mmap(f):
+    """
+    Copy an UploadedFile to a temp file and return (name, mmap, temp path).
+    The mmap duck-types as bytes for the pipeline, so peak RSS stays bounded
+    by the page cache instead of sum(pdf sizes).
+    """
+    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
+    try:
+        shutil.copyfileobj(f, tmp, length=1 << 20)
+        tmp.flush()
+        mm = mmap.mmap(tmp.fileno(), 0, access=mmap.ACCESS_READ)
+    except Exception:
+        # failed mid-spill: nothing was handed out, so reclaim our own temp file
+        tmp.close()
+        try:
+            os.unlink(tmp.name)
+        except OSError:
+            pass
+        raise
+    tmp.close()
+    return f.name, mm, tmp.name
+
+def _cleanup_spilled(spilled):
+    for _, mm, path in spilled:
+        try:
+            mm.close()
+            os.unlink(path)
+        except OSError:
+            pass
 
 def _normalize_datagrid(dg_df_raw: pd.DataFrame) -> pd.DataFrame:
     """
@@ -177,14 +371,14 @@ def _normalize_datagrid(dg_df_raw: pd.DataFrame) -> pd.DataFrame:
     - PropertyName (from Description/PropertyName/Name/etc.)
     """
     # Normalize headers to compare
-    normed = {str(c).strip().lower().replace(" ", "").replace("_",""): c for c in dg_df_raw.columns}
+    normed = {_norm_header(c): c for c in dg_df_raw.columns}
 
     prop_col = None
     desc_col = None
     for key, orig in normed.items():
-        if key in ["property", "propertycode", "prop", "propid", "propertyid", "property_code"]:
+        if key in DG_CODE_ALIASES:
             prop_col = orig
-        if key in ["description", "propertyname", "name", "propname", "property_description", "propertydesc"]:
+        if key in DG_NAME_ALIASES:
             desc_col = orig
 
     if not prop_col or not desc_col:
@@ -192,26 +386,63 @@ def _normalize_datagrid(dg_df_raw: pd.DataFrame) -> pd.DataFrame:
 
     return dg_df_raw.rename(columns={prop_col: "PropertyCode", desc_col: "PropertyName"})
 
+# blake3 hashes multi-GB/s with SIMD + multi-threading; optional accelerator,
+# SHA-256 (OpenSSL, SHA-NI on modern x86) otherwise.
+try:
+    import blake3
+    def _new_hasher(): return blake3.blake3(max_threads=blake3.blake3.AUTO)
+except ImportError:
+    def _new_hasher(): return hashlib.sha256()
+
+def _fingerprint(pdf_blobs, dg_bytes, vendor_df, template_bytes) -> bytes:
+    """Content hash of everything that influences the output workbook."""
+    h = _new_hasher()
+    for _, b in pdf_blobs:
+        h.update(memoryview(b))  # no copy into update()
+    h.update(dg_bytes)
+    h.update(pd.util.hash_pandas_object(vendor_df, index=True).values.tobytes())
+    h.update(template_bytes or b"")
+    return h.digest()
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _run_cached(key: bytes, _pdf_blobs, _datagrid, _vendor_df, _template_bytes, _property_maps=None):
+    # underscore args are excluded from Streamlit's hashing; key carries the
+    # content fingerprint, so a re-click with identical inputs skips OCR entirely
+    return run_pipeline_in_memory(_pdf_blobs, _datagrid, _vendor_df, _template_bytes,
+                                  property_maps=_property_maps)
+
 # ---- Main button ----
 if st.button("Process"):
     if not pdf_files or not dg_file:
         st.error("Please upload at least PDFs and DataGridExport.xlsx")
         st.stop()
 
+    spilled = []
     with st.spinner("Processing…"):
         try:
             # ---- DataGrid (Excel) -> robust column mapping
-            dg_df_raw = pd.read_excel(dg_file, engine="openpyxl")
+            dg_df_raw = _read_xlsx_fast(dg_file, dtype=DG_DTYPES,
+                                        required=(DG_CODE_ALIASES, DG_NAME_ALIASES), prune=True)
             datagrid_df = _normalize_datagrid(dg_df_raw)
+            # the pipeline only does lookups, so hand it bare arrays instead of
+            # a DataFrame and its block-manager overhead
+            dg_arrays = {
+                "PropertyCode": datagrid_df["PropertyCode"].to_numpy(dtype=object),
+                "PropertyName": datagrid_df["PropertyName"].to_numpy(dtype=object),
+            }
+            # build the lookup dicts once here; the pipeline takes them as-is
+            codes = [str(c) for c in dg_arrays["PropertyCode"]]
+            names = [str(n) for n in dg_arrays["PropertyName"]]
+            property_maps = (dict(zip(names, codes)), dict(zip(codes, names)))
 
             # ---- Vendor rules: uploaded OR default; accept wide or long formats
             if vendor_up is not None:
-                raw_vendor_df = pd.read_csv(vendor_up)
-                vendor_df = _normalize_vendor_df(raw_vendor_df)
+                raw_vendor_df = pd.read_csv(vendor_up, **_CSV_KW)
+                vendor_df = _normalize_vendor_df_cached(raw_vendor_df)
                 used_vendor = f"(override: {vendor_up.name})"
             else:
                 raw_vendor_df, used_vendor = _load_default_vendor_df()
-                vendor_df = _normalize_vendor_df(raw_vendor_df)
+                vendor_df = _normalize_vendor_df_cached(raw_vendor_df)
 
             # ---- Template: uploaded OR default (bytes)
             if tpl_up is not None:
@@ -219,33 +450,38 @@ if st.button("Process"):
                 used_tpl = f"(override: {tpl_up.name})"
             else:
                 if DEFAULT_TEMPLATE_PATH.exists():
-                    template_bytes = DEFAULT_TEMPLATE_PATH.read_bytes()
+                    template_bytes = _cached_default_template_bytes(DEFAULT_TEMPLATE_PATH.stat().st_mtime_ns)
                     used_tpl = f"(default: {DEFAULT_TEMPLATE_PATH.name})"
                 else:
                     template_bytes = None
                     used_tpl = "(auto-create new template)"
 
-            pdf_blobs = [(f.name, f.read()) for f in pdf_files]
-
-            # ---- Google Vision service-account JSON (if used)
-            if os.environ.get("OCR_PROVIDER","gcv").lower() == "gcv":
-                sa_json = os.environ.get("GOOGLE_APPLICATION_CREDENTIALS_JSON","")
-                if sa_json:
-                    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".json")
-                    tmp.write(sa_json.encode("utf-8")); tmp.flush()
-                    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = tmp.name
-
-            # ---- Run pipeline ----
-            out_bytes = run_pipeline_in_memory(pdf_blobs, datagrid_df, vendor_df, template_bytes)
+            # spills are I/O-bound; threads overlap them and ex.map keeps upload
+            # order. Workers register into `spilled` as they finish so the
+            # finally-block reclaims every completed spill even when one task
+            # fails mid-batch (list.append is thread-safe).
+            def _spill(f):
+                res = _spill_to_mmap(f)
+                spilled.append(res)
+                return res
+            with ThreadPoolExecutor(max_workers=min(8, len(pdf_files))) as ex:
+                ordered = list(ex.map(_spill, pdf_files))
+            pdf_blobs = [(name, mm) for name, mm, _ in ordered]
+
+            # ---- Run pipeline (memoized on input fingerprint) ----
+            key = _fingerprint(pdf_blobs, dg_file.getvalue(), vendor_df, template_bytes)
+            out_bytes = _run_cached(key, pdf_blobs, dg_arrays, vendor_df, template_bytes, property_maps)
 
         except Exception as e:
             st.error(f"Action needed: {e}")
             st.stop()
+        finally:
+            _cleanup_spilled(spilled)
 
     st.success(f"Done. Using vendor log {used_vendor} and template {used_tpl}. Download your workbook below.")
     st.download_button(
         "Download Mortgage_Consolidated.xlsx",
-        data=out_bytes.getvalue(),
+        data=out_bytes,
         file_name="Mortgage_Consolidated.xlsx",
         mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
     )
@@ -1,8 +1,19 @@
-import io, re, os
+import io, re, os, functools, hashlib, json, time, tempfile
+from collections import deque
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import pdfplumber
 from openpyxl import Workbook, load_workbook
 from rapidfuzz import fuzz, process
+try:
+    import ahocorasick  # pyahocorasick: one linear scan scores all vendors
+except ImportError:
+    ahocorasick = None
+try:
+    import fitz  # PyMuPDF: ~10x faster plain-text extraction than pdfplumber
+except ImportError:
+    fitz = None
 
 EXPECTED_HEADERS=[
  "Property","Mortgage 1st","Mortgage 2nd","Interest Mortgage 1st","Interest Mortgage 2nd",
@@ -14,14 +25,27 @@ HEADER_SYNONYMS={
  "reserve balance":"Other Escrows","tax escrow":"Tax Escrow","principal balance 1st":"Mortgage 1st",
  "principal balance 2nd":"Mortgage 2nd","interest 1st":"Interest Mortgage 1st","interest 2nd":"Interest Mortgage 2nd"
 }
+EXPECTED_HEADERS_SET=frozenset(EXPECTED_HEADERS)
+HEADER_TO_COL={h:i+2 for i,h in enumerate(EXPECTED_HEADERS)}
 LINEVALS=[re.compile(r"(?P<label>[A-Za-z \-_/&]+)[:\s]+(?P<val>\(?\$?[\d,]+(?:\.\d{1,2})?\)?)",re.I)]
+# fallback: label + numeric tail in one scan (replaces the old rsplit attempt)
+TAIL_RX=re.compile(r"^(.*?)[\s:.\-]+(\(?\$?[\d,]+(?:\.\d{1,2})?\)?)\s*$")
+_TRANS=str.maketrans("","","$,")
 
-def _norm(s): return re.sub(r"\s+"," ",(s or "").strip().lower().replace("_"," ").replace("-"," "))
+_WS_RX=re.compile(r"\s+")
+
+@functools.lru_cache(maxsize=1024)
+def _norm(s): return _WS_RX.sub(" ",(s or "").strip().lower().replace("_"," ").replace("-"," "))
+
+# normalized label -> header, baked at import; synonyms override exact headers
+# to preserve the old lookup order
+_NORM_TO_HEADER={_norm(h):h for h in EXPECTED_HEADERS}
+_NORM_TO_HEADER.update({_norm(k):v for k,v in HEADER_SYNONYMS.items()})
 def _parse_num(s):
     if not s: return None
     s=s.strip(); neg=s.startswith("(") and s.endswith(")")
     if neg: s=s[1:-1]
-    s=s.replace("$","").replace(",","")
+    s=s.translate(_TRANS)
     try: v=float(s); return -v if neg else v
     except: return None
 
@@ -31,60 +55,178 @@ def _label_val(line:str):
         if m:
             v=_parse_num(m.group("val"))
             if v is not None: return m.group("label").strip(), v
-    toks=line.rsplit(" ",1)
-    if len(toks)==2:
-        v=_parse_num(toks[1]); 
-        if v is not None: return toks[0].strip(" :.-"), v
+    m=TAIL_RX.match(line)
+    if m:
+        v=_parse_num(m.group(2))
+        if v is not None: return m.group(1).strip(" :.-"), v
     return None
 
-def _detect_vendor(full_text:str, vendor_df:pd.DataFrame):
+@functools.lru_cache(maxsize=4096)
+def _compiled(pat:str, flags:int=re.I|re.M):
+    return re.compile(pat, flags)
+
+def _build_vendor_rules(vendor_df:pd.DataFrame|None):
+    """One-time prep per pipeline run: compiled detect regexes and lowered
+    (pattern, header) pairs per vendor, so the per-PDF loop touches no
+    DataFrame and recompiles nothing."""
     if vendor_df is None or vendor_df.empty: return None
-    scores={}
+    # per-vendor alternation compiled once at vendor-load time (df.attrs);
+    # falls back to compiling individual patterns for frames built without it
+    detect_db=vendor_df.attrs.get("detect_db")
+    rules={}
     for v,grp in vendor_df.groupby("Vendor"):
-        score=0
-        if "DetectPattern" in grp.columns:
-            for pat in grp["DetectPattern"]:
-                if pat and re.search(pat,full_text,re.I|re.M): score+=5
-        for pat in grp["Pattern"]:
-            if pat and str(pat).lower() in full_text.lower(): score+=1
+        detect=[]
+        if detect_db is not None:
+            rx=detect_db.get(v)
+            if rx is not None: detect.append(rx)
+        elif "DetectPattern" in grp.columns:
+            # mirror the app-side detect_db: one alternation per vendor, so a
+            # PDF costs one regex scan per vendor however the frame was built
+            pats=[str(p) for p in dict.fromkeys(grp["DetectPattern"]) if p]
+            if pats:
+                try:
+                    detect.append(_compiled("|".join(f"(?:{p})" for p in pats)))
+                except re.error:
+                    for p in pats:  # one bad pattern shouldn't void the rest
+                        try: detect.append(_compiled(p))
+                        except re.error: pass
+        patterns=[(str(p).lower(), str(h)) for p,h in zip(grp["Pattern"],grp["MappedHeader"]) if p]
+        # header-mapping subset: only valid target headers, longest pattern first
+        map_patterns=sorted((t for t in patterns if t[1] in EXPECTED_HEADERS_SET), key=lambda t:-len(t[0]))
+        if detect or patterns: rules[v]={"detect":detect,"patterns":patterns,"map_patterns":map_patterns}
+    if not rules: return None
+    all_map=sorted((t for r in rules.values() for t in r["map_patterns"]), key=lambda t:-len(t[0]))
+    return {"vendors":rules, "automaton":_build_automaton(rules), "all_map_patterns":all_map}
+
+def _build_automaton(vendors:dict):
+    # all vendors' literal patterns in one Aho-Corasick automaton: a single
+    # pass over full_text replaces the per-vendor substring loop
+    if ahocorasick is None: return None
+    auto=ahocorasick.Automaton()
+    word2vendors={}
+    for v,r in vendors.items():
+        for pat,_ in r["patterns"]:
+            if pat: word2vendors.setdefault(pat,set()).add(v)
+    if not word2vendors: return None
+    for w,vs in word2vendors.items():
+        auto.add_word(w,(w,tuple(vs)))
+    auto.make_automaton()
+    return auto
+
+def _label_vals(lines:list[str]) -> list:
+    """Vectorized _label_val: one C-level str.extract pass over every line,
+    with the per-line fallback reserved for lines the primary regex misses."""
+    if not lines: return []
+    s=pd.Series(lines,dtype="object")
+    # a line with no digit can never yield a value; drop the bulk up front
+    s=s[s.str.contains(r"\d",regex=True,na=False)]
+    if s.empty: return []
+    extr=s.str.extract(LINEVALS[0])
+    vals=pd.to_numeric(
+        extr["val"].str.replace("$","",regex=False).str.replace(",","",regex=False)
+            .str.replace(r"^\((.*)\)$",r"-\1",regex=True),
+        errors="coerce")
+    out=[]
+    for ln,lbl,v in zip(s,extr["label"],vals):
+        if pd.notna(v): out.append((str(lbl).strip(),float(v)))
+        else: out.append(_label_val(ln))
+    return out
+
+def _detect_vendor(full_text:str, full_lower:str, rules:dict|None):
+    # caller lowers the document once; detect regexes are case-insensitive
+    # already and the literal scans reuse full_lower
+    if not rules: return None
+    scores={}
+    for v,r in rules["vendors"].items():
+        score=sum(5 for rx in r["detect"] if rx.search(full_text))
         if score: scores[v]=score
+    auto=rules["automaton"]
+    if auto is not None:
+        seen=set()
+        for _,(w,vs) in auto.iter(full_lower):
+            if w in seen: continue  # +1 per distinct pattern, same as the old loop
+            seen.add(w)
+            for v in vs: scores[v]=scores.get(v,0)+1
+    else:
+        for v,r in rules["vendors"].items():
+            score=sum(1 for pat,_ in r["patterns"] if pat and pat in full_lower)
+            if score: scores[v]=scores.get(v,0)+score
     return max(scores,key=scores.get) if scores else None
 
-def _map_header(lbl:str, vendor:str|None, vendor_df:pd.DataFrame):
-    if vendor_df is not None and not vendor_df.empty:
-        sub=vendor_df[vendor_df["Vendor"]==vendor] if vendor else vendor_df
-        for _,r in sub.iterrows():
-            pat=str(r.get("Pattern","")); hdr=str(r.get("MappedHeader",""))
-            if pat and pat.lower() in lbl.lower() and hdr in EXPECTED_HEADERS: return hdr
+def _vendor_map_patterns(vendor:str|None, rules:dict|None):
+    # per-PDF constant: hoist out of the line loop
+    if not rules: return ()
+    if vendor: return rules["vendors"].get(vendor,{}).get("map_patterns",())
+    return rules["all_map_patterns"]
+
+def _map_header(lbl:str):
     n=_norm(lbl)
-    if n in HEADER_SYNONYMS: return HEADER_SYNONYMS[n]
-    for h in EXPECTED_HEADERS:
-        if _norm(h)==n: return h
+    hdr=_NORM_TO_HEADER.get(n)
+    if hdr: return hdr
     if "reserve" in n: return "Other Escrows"
     return None
 
-def _resolve_property(full_text:str, name2code:dict, code2name:dict):
-    for c in code2name:
-        if re.search(rf"\b{re.escape(c)}\b",full_text,re.I): return c
-    for n,c in name2code.items():
-        if re.search(rf"\b{re.escape(n)}\b",full_text,re.I): return c
-    m=process.extractOne(full_text[:5000],list(name2code),scorer=fuzz.partial_ratio)
-    if m and m[1] >= 92: return name2code[m[0]]
+def _build_property_rx(name2code:dict, code2name:dict):
+    """Collapse all codes (then all names) into one compiled alternation each,
+    plus a lowered match->code map, built once per pipeline run."""
+    def _alt(keys):
+        return re.compile(r"\b("+"|".join(re.escape(k) for k in keys)+r")\b",re.I) if keys else None
+    match2code={c.lower():c for c in code2name}
+    match2code.update({n.lower():c for n,c in name2code.items()})
+    return _alt(code2name), _alt(name2code), match2code, tuple(name2code)
+
+def _resolve_property(full_text:str, name2code:dict, prop_rx:tuple):
+    code_rx, name_rx, match2code, name_list = prop_rx
+    for rx in (code_rx, name_rx):
+        if rx is not None:
+            m=rx.search(full_text)
+            if m: return match2code[m.group(1).lower()]
+    # score_cutoff lets rapidfuzz prune candidates early; returns None below it
+    m=process.extractOne(full_text[:5000],name_list,scorer=fuzz.partial_ratio,score_cutoff=92)
+    if m: return name2code[m[0]]
     raise RuntimeError("Clarification needed: PropertyCode not found")
 
+# statement data lives in the first page or two; stop decoding once we have
+# plenty of text instead of walking a multi-hundred-page document
+_PDF_MAX_CHARS=int(os.environ.get("PDF_MAX_CHARS", 200_000))
+_PDF_MAX_LINES=int(os.environ.get("PDF_MAX_LINES", 4000))
+
 def _read_text_with_plumber(pdf_bytes:bytes):
     import warnings, io as _io
-    text_lines=[]; full=[]
+    text_lines=[]; full=[]; chars=0
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
         with pdfplumber.open(_io.BytesIO(pdf_bytes)) as doc:
             for p in doc.pages:
                 t=p.extract_text() or ""
                 if t:
-                    full.append(t)
+                    full.append(t); chars+=len(t)
                     text_lines+= [ln.strip() for ln in t.splitlines() if ln.strip()]
+                p.flush_cache()  # bound pdfplumber's per-page object retention
+                if chars > _PDF_MAX_CHARS or len(text_lines) > _PDF_MAX_LINES: break
+    return "\n".join(full), text_lines
+
+def _read_text_with_fitz(pdf_bytes:bytes):
+    data=pdf_bytes if isinstance(pdf_bytes,(bytes,bytearray)) else bytes(pdf_bytes)
+    text_lines=[]; full=[]; chars=0
+    doc=fitz.open(stream=data, filetype="pdf")
+    try:
+        for p in doc:
+            t=p.get_text("text") or ""
+            if t:
+                full.append(t); chars+=len(t)
+                text_lines+= [ln.strip() for ln in t.splitlines() if ln.strip()]
+            if chars > _PDF_MAX_CHARS or len(text_lines) > _PDF_MAX_LINES: break
+    finally:
+        doc.close()
     return "\n".join(full), text_lines
 
+def _read_text(pdf_bytes:bytes):
+    if fitz is not None:
+        try: return _read_text_with_fitz(pdf_bytes)
+        except Exception: pass  # malformed for MuPDF; let pdfplumber try
+    return _read_text_with_plumber(pdf_bytes)
+
 # ---- OCR Adapters (choose via env OCR_PROVIDER = 'gcv' or 'azure') ----
 def _ocr_google(pdf_bytes:bytes) -> tuple[str,list[str]]:
     # GOOGLE_APPLICATION_CREDENTIALS_FILE is created in app at runtime from secret JSON
@@ -110,12 +252,49 @@ def _ocr_azure(pdf_bytes:bytes) -> tuple[str,list[str]]:
             if ln.content: lines.append(ln.content.strip())
     return "\n".join(lines), lines
 
+# ---- Extraction cache (opt-in via OCR_CACHE=1; OCR calls are the slow and
+# billable step, and Streamlit sessions re-upload the same PDFs a lot).
+# Off by default since the UI promises uploads are discarded after the run.
+_OCR_CACHE_TTL = int(os.environ.get("OCR_CACHE_TTL", 24*3600))
+
+def _ocr_cache_enabled(): return os.environ.get("OCR_CACHE","") == "1"
+
+def _ocr_cache_file(h:str):
+    return os.path.join(tempfile.gettempdir(), "mortgage_ocr_cache", h+".json")
+
+def _ocr_cache_get(h:str):
+    p=_ocr_cache_file(h)
+    try:
+        if time.time()-os.path.getmtime(p) > _OCR_CACHE_TTL: return None
+        with open(p, encoding="utf-8") as fh: d=json.load(fh)
+        return d["full"], d["lines"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def _ocr_cache_put(h:str, full:str, lines:list[str]):
+    p=_ocr_cache_file(h)
+    try:
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        with open(p, "w", encoding="utf-8") as fh: json.dump({"full":full,"lines":lines}, fh)
+    except OSError:
+        pass  # cache is best-effort
+
 def extract_text_or_ocr(pdf_bytes:bytes) -> tuple[str,list[str]]:
-    full, lines = _read_text_with_plumber(pdf_bytes)
-    if full.strip() and len(lines) >= 3: return full, lines
-    provider = os.environ.get("OCR_PROVIDER","gcv").lower()
-    if provider == "azure": return _ocr_azure(pdf_bytes)
-    return _ocr_google(pdf_bytes)
+    h=None
+    if _ocr_cache_enabled():
+        h=hashlib.blake2b(pdf_bytes, digest_size=16).hexdigest()
+        hit=_ocr_cache_get(h)
+        if hit is not None: return hit
+    full, lines = _read_text(pdf_bytes)
+    if not (full.strip() and len(lines) >= 3):
+        # OCR clients require real bytes: protobuf rejects mmap/buffer objects,
+        # so coerce once here before dispatching to either adapter
+        if not isinstance(pdf_bytes, bytes):
+            pdf_bytes = bytes(pdf_bytes)
+        provider = os.environ.get("OCR_PROVIDER","gcv").lower()
+        full, lines = _ocr_azure(pdf_bytes) if provider == "azure" else _ocr_google(pdf_bytes)
+    if h: _ocr_cache_put(h, full, lines)
+    return full, lines
 
 def _prep_template(xlsx_bytes:bytes|None):
     if xlsx_bytes:
@@ -124,38 +303,92 @@ def _prep_template(xlsx_bytes:bytes|None):
     else:
         wb=Workbook(); wb.create_sheet("Mortgage Import",0)
     ws=wb["Mortgage Import"]
+    # clear values only — the template's data rows carry number formats
+    # (accounting style) that must survive into the output
     for row in ws.iter_rows(min_row=5, max_row=max(ws.max_row,5)):
         for c in row: c.value=None
     ws.cell(4,1,"#")
     for i,h in enumerate(EXPECTED_HEADERS, start=2): ws.cell(4,i,h)
     return wb, ws
 
-def run_pipeline_in_memory(pdf_blobs:list[tuple[str,bytes]],
-                           datagrid_df:pd.DataFrame,
+def _write_with_xlsxwriter(rows:list[list]) -> bytes:
+    # streaming writer: constant_memory keeps one row in RAM at a time
+    import xlsxwriter
+    out=io.BytesIO()
+    wb=xlsxwriter.Workbook(out,{"constant_memory":True,"strings_to_numbers":False})
+    ws=wb.add_worksheet("Mortgage Import")
+    ws.write_row(3,0,["#"]+EXPECTED_HEADERS)
+    for i,row in enumerate(rows,start=4):
+        ws.write_row(i,0,row)
+    wb.close()
+    return out.getvalue()
+
+def run_pipeline_in_memory(pdf_blobs:Iterable[tuple[str,bytes]],
+                           datagrid:dict,
                            vendor_df:pd.DataFrame|None,
-                           template_bytes:bytes|None) -> io.BytesIO:
-    if not {"PropertyCode","PropertyName"}.issubset(datagrid_df.columns):
-        raise RuntimeError("DataGridExport.csv must include PropertyCode,PropertyName")
-    name2code=dict(zip(datagrid_df["PropertyName"].astype(str), datagrid_df["PropertyCode"].astype(str)))
-    code2name=dict(zip(datagrid_df["PropertyCode"].astype(str), datagrid_df["PropertyName"].astype(str)))
+                           template_bytes:bytes|None,
+                           property_maps:tuple[dict,dict]|None=None) -> bytes:
+    # datagrid is a plain {"PropertyCode": seq, "PropertyName": seq} mapping;
+    # the lookup tables below are all the pipeline ever needed from it.
+    # Callers that already hold (name2code, code2name) pass property_maps
+    # so the dicts are built exactly once.
+    if property_maps is not None:
+        name2code, code2name = property_maps
+    else:
+        if not {"PropertyCode","PropertyName"} <= set(datagrid):
+            raise RuntimeError("DataGridExport.csv must include PropertyCode,PropertyName")
+        codes=[str(c) for c in datagrid["PropertyCode"]]
+        names=[str(n) for n in datagrid["PropertyName"]]
+        name2code=dict(zip(names,codes))
+        code2name=dict(zip(codes,names))
 
-    wb, ws = _prep_template(template_bytes)
-    for row in ws.iter_rows(min_row=5, max_row=max(ws.max_row,5)):
-        for c in row: c.value=None
+    vendor_rules = _build_vendor_rules(vendor_df)
+    prop_rx = _build_property_rx(name2code, code2name)
 
-    r, cnt = 5, 1
-    for fname, blob in pdf_blobs:
-        full, lines = extract_text_or_ocr(blob)
-        vendor = _detect_vendor(full, vendor_df) if vendor_df is not None else None
-        prop = _resolve_property(full, name2code, code2name)  # raises single clarification if needed
-        for ln in lines:
-            lv = _label_val(ln)
+    out_rows, cnt = [], 1
+    width = len(EXPECTED_HEADERS)
+
+    def _consume(full:str, lines:list[str]):
+        nonlocal cnt
+        full_lower = full.lower()  # one allocation per document, reused below
+        vendor = _detect_vendor(full, full_lower, vendor_rules)
+        prop = _resolve_property(full, name2code, prop_rx)  # raises single clarification if needed
+        pairs = _vendor_map_patterns(vendor, vendor_rules)
+        # fused pass: label already extracted+parsed, pattern scan and row
+        # build inline — no per-line function dispatch beyond the fallback
+        for lv in _label_vals(lines):
             if not lv: continue
-            hdr = _map_header(lv[0], vendor, vendor_df)
+            lbl, val = lv
+            lbl_l = lbl.lower()
+            hdr = next((h for p,h in pairs if p in lbl_l), None) or _map_header(lbl)
             if not hdr: continue
-            col = EXPECTED_HEADERS.index(hdr)+2
-            ws.cell(r,1,cnt); ws.cell(r,2,prop); ws.cell(r,col,lv[1])
-            r += 1; cnt += 1
+            row = [cnt]+[None]*width
+            row[1] = prop; row[HEADER_TO_COL[hdr]-1] = val
+            out_rows.append(row); cnt += 1
 
-    out = io.BytesIO(); wb.save(out); out.seek(0)
-    return out
+    # extraction is network-bound (OCR) or releases the GIL (pdfplumber I/O),
+    # so fan out per PDF. pdf_blobs is consumed lazily with a bounded window:
+    # at most ~2x workers blobs and extracted texts are in flight, and results
+    # are drained in order (openpyxl writes stay serial; it isn't thread-safe).
+    workers = max(1, int(os.environ.get("MAX_OCR_WORKERS","8")))
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for fname, blob in pdf_blobs:
+            pending.append(ex.submit(extract_text_or_ocr, blob))
+            if len(pending) >= 2*workers:
+                _consume(*pending.popleft().result())
+        while pending:
+            _consume(*pending.popleft().result())
+
+    if not template_bytes:
+        return _write_with_xlsxwriter(out_rows)
+
+    wb, ws = _prep_template(template_bytes)
+    # write into the cleared (still styled) cells; append would add rows
+    # without the template's formatting
+    for r, row in enumerate(out_rows, start=5):
+        for j, v in enumerate(row, start=1):
+            if v is not None: ws.cell(r,j,v)
+
+    out = io.BytesIO(); wb.save(out)
+    return out.getvalue()